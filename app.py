@@ -16,18 +16,26 @@ v2.3 / 最終更新: 2025-10-02
 """
 
 from fastapi import FastAPI, UploadFile, Request
-from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse, PlainTextResponse
+from fastapi.responses import HTMLResponse, StreamingResponse, RedirectResponse, PlainTextResponse, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 
 import pandas as pd
+from pandas.tseries.api import guess_datetime_format
+import numpy as np
 import io
 import json
 from pathlib import Path
 from datetime import datetime
 import zipfile
+import time
 import re
 import traceback
+import functools
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO
 
 # ─────────────────────────────────────
 # 基本
@@ -40,6 +48,9 @@ STATIC_DIR.mkdir(exist_ok=True)
 APP_VERSION = "v2.3"
 APP_DATE = datetime.now().strftime("%Y-%m-%d")
 
+# /convert の変換処理を流すスレッドプール（CPU数で上限）
+EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count())
+
 app = FastAPI()
 app.add_middleware(
     CORSMiddleware,
@@ -102,31 +113,55 @@ CONFIG = load_config()
 # ─────────────────────────────────────
 # 小物
 # ─────────────────────────────────────
-def normalize_tax(name: str):
-    return CONFIG["TAX_MAP"].get(name, name)
+def normalize_tax_series(s: pd.Series, tax_map: dict) -> pd.Series:
+    # dict による map は C 側で引ける。対応なしは元の値のまま
+    # （None キーは本当に None のセルだけに当て，NaN は従来どおり欠損のまま）
+    out = s.map({k: v for k, v in tax_map.items() if k is not None}).fillna(s)
+    if None in tax_map and s.dtype == object:
+        is_none = np.equal(s.to_numpy(), None)
+        if is_none.any():
+            out = out.mask(is_none, tax_map[None])
+    return out
 
 def _coerce_str(s: pd.Series) -> pd.Series:
-    return s.astype(str).replace({"nan": "", "NaT": ""}).fillna("")
-
-def _read_csv_safely(file_bytes: bytes) -> pd.DataFrame:
+    arr = s.to_numpy(dtype=object, na_value="").astype(str)
+    arr[(arr == "nan") | (arr == "NaT")] = ""
+    return pd.Series(arr, index=s.index, dtype=object)
+
+def _to_arrow_strings(df: pd.DataFrame) -> pd.DataFrame:
+    # 文字列だけの object 列を Arrow 文字列へ（pandas 3 では読み込み時点で Arrow 文字列）
+    # 金額列は対象外：Arrow 文字列に to_numeric をかけると pandas 2 では Int64 になり，100.0 が 100 と出てしまう
+    amount = CONFIG["SRC_HEADERS"].get("amount")
+    conv = {
+        c: "string[pyarrow]" for c, t in df.dtypes.items()
+        if t == object and str(c).strip() != amount
+        and pd.api.types.infer_dtype(df[c], skipna=True) == "string"
+    }
+    return df.astype(conv) if conv else df
+
+def _read_csv_safely(f: BinaryIO) -> pd.DataFrame:
     for enc in ("cp932", "utf-8-sig", "utf-8"):
         try:
-            return pd.read_csv(io.BytesIO(file_bytes), encoding=enc)
+            f.seek(0)
+            return _to_arrow_strings(pd.read_csv(f, encoding=enc))
         except Exception:
             continue
-    return pd.read_csv(io.BytesIO(file_bytes), encoding_errors="ignore")
+    f.seek(0)
+    return _to_arrow_strings(pd.read_csv(f, encoding_errors="ignore"))
 
-def _read_base(file_bytes: bytes, filename: str) -> pd.DataFrame:
+def _read_base(f: BinaryIO, filename: str) -> pd.DataFrame:
     name = (filename or "").lower()
     if name.endswith(".csv"):
-        return _read_csv_safely(file_bytes)
-    xls = pd.ExcelFile(io.BytesIO(file_bytes))
+        return _read_csv_safely(f)
+    f.seek(0)
+    xls = pd.ExcelFile(f)
     sheet = CONFIG.get("INPUT_SHEET", "②データ貼付")
     if sheet not in xls.sheet_names:
         cand = [s for s in xls.sheet_names if "データ貼" in s]
         sheet = cand[0] if cand else xls.sheet_names[0]
-    return pd.read_excel(io.BytesIO(file_bytes), sheet_name=sheet)
+    return _to_arrow_strings(xls.parse(sheet))
 
+@functools.lru_cache(maxsize=None)
 def _col_letter_to_idx(col: str) -> int:
     col = col.strip().upper()
     val = 0
@@ -135,51 +170,100 @@ def _col_letter_to_idx(col: str) -> int:
             val = val * 26 + (ord(ch) - ord("A") + 1)
     return val - 1
 
-def _pick_by_letter(row: pd.Series, letters: list[str]) -> list[str]:
-    values = []
-    for col in letters:
-        idx = _col_letter_to_idx(col)
-        v = row.iloc[idx] if 0 <= idx < len(row) else ""
-        values.append("" if pd.isna(v) else str(v))
-    return values
-
-def _join_clean(parts: list[str], sep: str = " ") -> str:
-    parts = [p for p in [p.strip() for p in parts] if p]
-    return sep.join(parts)
-
-def _format_mmdd(val) -> str:
+def _parse_date_each(val):
     try:
         dt = pd.to_datetime(val, errors="coerce")
-        if pd.isna(dt):
-            m = re.search(r"(\d{1,2})[/-](\d{1,2})", str(val))
-            if m:
-                return f"{int(m.group(1)):02d}/{int(m.group(2)):02d}"
-            return str(val)
-        return dt.strftime("%m/%d")
-    except Exception:
-        return str(val)
+    except (ValueError, TypeError):
+        return pd.NaT
+    if pd.isna(dt):
+        return pd.NaT
+    return dt.tz_localize(None) if dt.tzinfo is not None else dt
+
+def _parse_dates(s: pd.Series) -> pd.Series:
+    # 列まとめて解釈できない（tz 付き・なしの混在など）ときは1件ずつ解釈する
+    try:
+        dt = pd.to_datetime(s, errors="coerce", format="mixed")
+        if pd.api.types.is_datetime64_any_dtype(dt):
+            return dt
+    except (ValueError, TypeError):
+        pass
+    return pd.to_datetime(s.map(_parse_date_each))
+
+def _dates_reusable_for_memo(s: pd.Series) -> bool:
+    # 日付列の解釈結果を摘要(C列)でも使い回せるか：文字列の列で，pandas が先頭値から推定する書式が
+    # 年始まり（または推定なし＝1件ずつ解釈）なら，1件ずつ解釈した場合と結果が一致する
+    if not pd.api.types.is_string_dtype(s):
+        return False
+    for v in s:
+        if pd.isna(v) or str(v).strip().lower() in ("", "nan", "nat", "none", "null"):
+            continue
+        fmt = guess_datetime_format(str(v))
+        return fmt is None or fmt.startswith("%Y")
+    return True
+
+_MMDD_RE = re.compile(r"(\d{1,2})[/-](\d{1,2})")
+# 月*32+日 → "mm/dd" の早見表（strftime を行ごとに呼ばない）
+_MMDD_TABLE = np.array([f"{m:02d}/{d:02d}" for m in range(13) for d in range(32)], dtype=object)
+
+def _format_mmdd_series(s: pd.Series, dates: pd.Series | None = None) -> pd.Series:
+    dt = None
+    if dates is not None:
+        dt = dates
+        unparsed = dt.isna()
+        if unparsed.any():
+            try:
+                dt = dt.mask(unparsed, _parse_dates(s[unparsed]))
+            except (ValueError, TypeError):
+                dt = None
+        if dt is not None and not pd.api.types.is_datetime64_any_dtype(dt):
+            dt = None  # tz 付き・なしが混ざった → C列を自前で解釈し直す
+    if dt is None:
+        dt = _parse_dates(s)
+    month = dt.dt.month.to_numpy(dtype="int64", na_value=0)
+    day = dt.dt.day.to_numpy(dtype="int64", na_value=0)
+    out = pd.Series(_MMDD_TABLE[month * 32 + day], index=s.index, dtype=object)
+    miss = dt.isna()
+    if miss.any():
+        raw = s[miss].astype(str)
+        m = raw.str.extract(_MMDD_RE)
+        mmdd = m[0].str.zfill(2) + "/" + m[1].str.zfill(2)
+        out = out.mask(miss, mmdd.where(m[0].notna(), raw))
+    return out
 
 # ─────────────────────────────────────
 # ②データ貼付 → カテゴリ振り分け
 # ─────────────────────────────────────
-def split_categories(df: pd.DataFrame):
+_AMEX_WORDS = ("amex", "アメックス")
+
+def _contains_any(s: pd.Series, words) -> pd.Series:
+    # 判定列は種類が少ないので，ユニーク値だけを小文字化して固定文字列で部分一致し，行へ展開する
+    codes, uniques = pd.factorize(s)
+    u = _coerce_str(pd.Series(uniques, dtype=object)).str.lower()
+    hit = np.zeros(len(u) + 1, dtype=bool)  # 末尾は欠損(code=-1)用
+    for w in words:
+        hit[:-1] |= u.str.contains(w, regex=False, na=False).to_numpy(dtype=bool)
+    return pd.Series(hit[codes], index=s.index)
+
+def category_masks(df: pd.DataFrame) -> tuple[pd.DataFrame, dict[str, np.ndarray]]:
     h = CONFIG["SRC_HEADERS"]
-    df = df.copy()
-    df.columns = [str(c).strip() for c in df.columns]
+    df = df.set_axis([str(c).strip() for c in df.columns], axis=1)
 
     amex = pd.Series(False, index=df.index)
     if h.get("pay_method") in df.columns:
-        amex = amex | _coerce_str(df[h["pay_method"]]).str.contains("AMEX|アメックス", case=False, na=False)
+        amex = amex | _contains_any(df[h["pay_method"]], _AMEX_WORDS)
     if h.get("card_brand") in df.columns:
-        amex = amex | _coerce_str(df[h["card_brand"]]).str.contains("AMEX|アメックス", case=False, na=False)
+        # 支払方法で AMEX と判定済みの行はカード列を見ない
+        rest = ~amex.to_numpy()
+        if rest.any():
+            amex[rest] = _contains_any(df[h["card_brand"]][rest], _AMEX_WORDS).to_numpy()
 
     kotsu = pd.Series(False, index=df.index)
     if h.get("ticket_type") in df.columns:
-        kotsu = _coerce_str(df[h["ticket_type"]]).str.contains("交通費", na=False)
-
-    keihi = (~amex) & (~kotsu)
+        kotsu = _contains_any(df[h["ticket_type"]], ("交通費",))
 
-    return df[amex].copy(), df[keihi].copy(), df[kotsu & (~amex)].copy()
+    amex = amex.to_numpy()
+    kotsu = kotsu.to_numpy()
+    return df, {"amex": amex, "keihi": ~amex & ~kotsu, "kotsuhi": kotsu & ~amex}
 
 # ─────────────────────────────────────
 # 摘要（行ごと）
@@ -190,53 +274,89 @@ _MEMO_PARTS = {
     "kotsuhi": ["G", "C", "M", "K", "P"],
 }
 
-def build_memo_series(df: pd.DataFrame, kind: str) -> pd.Series:
+def _letter_column(df: pd.DataFrame, letter: str, rows: np.ndarray | None = None) -> pd.Series:
+    idx = _col_letter_to_idx(letter)
+    if not 0 <= idx < df.shape[1]:
+        return pd.Series("", index=df.index if rows is None else df.index[rows], dtype=object)
+    col = df.iloc[:, idx]
+    if rows is not None:
+        col = col[rows]
+    return col.astype(str).where(col.notna(), "").str.strip()
+
+def _join_clean_columns(cols: list[pd.Series], sep: str = " ") -> pd.Series:
+    out = cols[0]
+    for col in cols[1:]:
+        glue = pd.Series(sep, index=out.index).where((out != "") & (col != ""), "")
+        out = out + glue + col
+    return out
+
+def build_memo_series(df: pd.DataFrame, kind: str, dates: pd.Series | None = None,
+                      rows: np.ndarray | None = None) -> pd.Series:
     parts = _MEMO_PARTS[kind]
-    memos = []
-    for _, row in df.reset_index(drop=True).iterrows():
-        vals = _pick_by_letter(row, parts)
-        for i, letter in enumerate(parts):
-            if letter.upper() == "C":
-                vals[i] = _format_mmdd(vals[i])
-        memos.append(_join_clean(vals, " "))
-    return pd.Series(memos, index=df.index)
+    cols = []
+    for letter in parts:
+        col = _letter_column(df, letter, rows)
+        if letter.upper() == "C":
+            col = _format_mmdd_series(col, dates).str.strip()
+        cols.append(col)
+    return _join_clean_columns(cols, " ")
 
 # ─────────────────────────────────────
 # 複合仕訳の生成
 # ─────────────────────────────────────
-def build_compound_voucher(df: pd.DataFrame, kind: str, voucher_id: str) -> pd.DataFrame:
+def build_compound_voucher(df: pd.DataFrame, kind: str, voucher_id: str,
+                           rows: np.ndarray | None = None) -> pd.DataFrame:
+    # rows を渡すと全列の行抽出はせず，使う列だけをその行で取り出す
     h = CONFIG["SRC_HEADERS"]
-    memos = build_memo_series(df, kind)
+    tax_map = CONFIG["TAX_MAP"]
+    credit = CONFIG["CREDIT_RULES"][kind]
+    out_cols = CONFIG["OUTPUT_COLUMNS"]
+    index = df.index if rows is None else df.index[rows]
 
-    deb = pd.DataFrame({
-        "伝票番号": voucher_id,
-        "日付": pd.to_datetime(df[h["date"]], errors="coerce").dt.strftime("%Y-%m-%d"),
-        "借方勘定科目": df[h["account"]],
-        "借方補助科目": df[h["subaccount"]] if h["subaccount"] in df.columns else "",
-        "借方部門": df[h["dept"]] if h["dept"] in df.columns else "",
-        "借方税区分": df[h["tax"]].map(normalize_tax) if h["tax"] in df.columns else "対象外",
-        "借方金額": pd.to_numeric(df[h["amount"]], errors="coerce"),
-        "借方摘要": memos,
-    })
+    def col(name: str) -> pd.Series:
+        return df[name] if rows is None else df[name][rows]
 
-    credit = CONFIG["CREDIT_RULES"][kind]
-    total = deb["借方金額"].sum(skipna=True)
-    credit_amounts = [total] + [0] * (len(deb) - 1)
+    date_src = col(h["date"])
+    dates = pd.to_datetime(date_src, errors="coerce")
+    c_idx = _col_letter_to_idx("C")
+    c_is_date = (c_idx < df.shape[1] and df.columns[c_idx] == h["date"]
+                 and _dates_reusable_for_memo(date_src))
+    memos = build_memo_series(df, kind, dates=dates if c_is_date else None, rows=rows)
 
-    cred = pd.DataFrame({
+    amounts = pd.to_numeric(col(h["amount"]), errors="coerce")
+
+    # 金額がすべて整数なら貸方も整数列のまま（CSV に 100.0 / 0.0 と出さない）
+    int_amounts = pd.api.types.is_integer_dtype(amounts.dtype)
+    credit_amounts = np.zeros(len(index), dtype=np.int64 if int_amounts else np.float64)
+    if len(index):
+        credit_amounts[0] = (amounts.sum() if int_amounts
+                             else np.nansum(amounts.to_numpy(dtype=np.float64, na_value=np.nan)))
+
+    src = {
+        "伝票番号": voucher_id,
+        "日付": dates.dt.strftime("%Y-%m-%d"),
+        "借方勘定科目": col(h["account"]),
+        "借方補助科目": col(h["subaccount"]) if h["subaccount"] in df.columns else "",
+        "借方部門": col(h["dept"]) if h["dept"] in df.columns else "",
+        "借方税区分": normalize_tax_series(col(h["tax"]), tax_map) if h["tax"] in df.columns else "対象外",
+        "借方金額": amounts,
+        "借方摘要": memos,
         "貸方勘定科目": credit["貸方勘定科目"],
         "貸方補助科目": credit.get("貸方補助科目", ""),
         "貸方部門": credit.get("貸方部門", ""),
         "貸方税区分": credit.get("貸方税区分", "対象外"),
         "貸方金額": credit_amounts,
-        "貸方摘要": memos.values,
-    }, index=deb.index)
-
-    out = pd.concat([deb, cred], axis=1)
-    out["備考"] = ""
-    out = out.reindex(columns=CONFIG["OUTPUT_COLUMNS"], fill_value="")
-    out = out[pd.notna(out["借方金額"])]
-    return out
+        "貸方摘要": memos,
+        "備考": "",
+    }
+
+    # 出力列の順に1回で組み立てる（金額が空の行は除外）
+    keep = amounts.notna().to_numpy()
+    cols = {}
+    for name in out_cols:
+        v = src.get(name, "")
+        cols[name] = v[keep] if isinstance(v, (pd.Series, np.ndarray)) else v
+    return pd.DataFrame(cols, index=index[keep], copy=False)
 
 # ─────────────────────────────────────
 # 画面（トップ・マニュアル・設定）
@@ -358,14 +478,23 @@ MANUAL_HTML = f"""<!DOCTYPE html>
   <p><a href="/">← トップに戻る</a></p>
 </body></html>"""
 
+# 静的ページは起動時に1度だけエンコードしておく
+def _html_headers(body: bytes) -> dict:
+    return {"content-type": "text/html; charset=utf-8", "content-length": str(len(body))}
+
+_INDEX_BYTES = INDEX_HTML.encode("utf-8")
+_INDEX_HEADERS = _html_headers(_INDEX_BYTES)
+_MANUAL_BYTES = MANUAL_HTML.encode("utf-8")
+_MANUAL_HEADERS = _html_headers(_MANUAL_BYTES)
+
 # ── 画面ルーティング
 @app.get("/", response_class=HTMLResponse)
 async def index():
-    return HTMLResponse(INDEX_HTML)
+    return Response(content=_INDEX_BYTES, headers=_INDEX_HEADERS)
 
 @app.get("/manual", response_class=HTMLResponse)
 async def manual():
-    return HTMLResponse(MANUAL_HTML)
+    return Response(content=_MANUAL_BYTES, headers=_MANUAL_HEADERS)
 
 @app.get("/settings", response_class=HTMLResponse)
 async def settings_page():
@@ -409,46 +538,58 @@ async def save_settings(request: Request):
 
     save_config(cfg)
     global CONFIG
-    CONFIG = load_config()
+    CONFIG = cfg
     return RedirectResponse(url="/settings", status_code=303)
 
 # ── 変換API（複合仕訳）
+def _write_csv_entry(zf: zipfile.ZipFile, name: str, frames: list[pd.DataFrame]) -> None:
+    # CSV を zip エントリへ直接書き出す（ヘッダは先頭のみ＝縦結合と同じ出力）
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zf.compression
+    with zf.open(info, mode="w", force_zip64=True) as entry:
+        with io.TextIOWrapper(entry, encoding="utf-8-sig", newline="") as w:
+            for i, frame in enumerate(frames):
+                frame.to_csv(w, index=False, header=(i == 0))
+
+def _process(src: BinaryIO, filename: str) -> tuple[io.BytesIO, str]:
+    df = _read_base(src, filename)
+
+    df, masks = category_masks(df)
+
+    outputs = {}
+    seq = 1
+    today_key = datetime.now().strftime("%Y%m%d")
+
+    if masks["amex"].any():
+        outputs["amex"] = build_compound_voucher(df, "amex",  f"AMEX-{today_key}-{seq:03d}", masks["amex"]); seq += 1
+    if masks["keihi"].any():
+        outputs["keihi"] = build_compound_voucher(df, "keihi", f"KEIHI-{today_key}-{seq:03d}", masks["keihi"]); seq += 1
+    if masks["kotsuhi"].any():
+        outputs["kotsuhi"] = build_compound_voucher(df, "kotsuhi", f"KOTSU-{today_key}-{seq:03d}", masks["kotsuhi"]); seq += 1
+
+    mem = io.BytesIO()
+    with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        nonempty = []
+        for kind, df_out in outputs.items():
+            if df_out.empty: continue
+            _write_csv_entry(zf, f"{kind}_journal_freee.csv", [df_out])
+            nonempty.append(df_out)
+        if nonempty:
+            _write_csv_entry(zf, "merged_all_freee.csv", nonempty)
+        else:
+            zf.writestr("README.txt", "②データ貼付から振り分けできませんでした。列名や判定列をご確認ください。".encode("utf-8"))
+
+    mem.seek(0)
+    zip_name = f"freee_journals_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+    return mem, zip_name
+
 @app.post("/convert")
 async def convert(file: UploadFile):
     try:
-        raw = await file.read()
-        df = _read_base(raw, file.filename or "uploaded")
-
-        amex_df, keihi_df, kotsu_df = split_categories(df)
-
-        outputs = {}
-        seq = 1
-        today_key = datetime.now().strftime("%Y%m%d")
-
-        if not amex_df.empty:
-            outputs["amex"] = build_compound_voucher(amex_df, "amex",  f"AMEX-{today_key}-{seq:03d}"); seq += 1
-        if not keihi_df.empty:
-            outputs["keihi"] = build_compound_voucher(keihi_df, "keihi", f"KEIHI-{today_key}-{seq:03d}"); seq += 1
-        if not kotsu_df.empty:
-            outputs["kotsuhi"] = build_compound_voucher(kotsu_df, "kotsuhi", f"KOTSU-{today_key}-{seq:03d}"); seq += 1
-
-        mem = io.BytesIO()
-        with zipfile.ZipFile(mem, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
-            wrote = 0
-            for kind, df_out in outputs.items():
-                if df_out.empty: continue
-                buf = io.StringIO(); df_out.to_csv(buf, index=False)
-                zf.writestr(f"{kind}_journal_freee.csv", buf.getvalue().encode("utf-8-sig"))
-                wrote += 1
-            if wrote:
-                merged = pd.concat([d for d in outputs.values() if not d.empty], ignore_index=True)
-                buf = io.StringIO(); merged.to_csv(buf, index=False)
-                zf.writestr("merged_all_freee.csv", buf.getvalue().encode("utf-8-sig"))
-            else:
-                zf.writestr("README.txt", "②データ貼付から振り分けできませんでした。列名や判定列をご確認ください。".encode("utf-8"))
-
-        mem.seek(0)
-        filename = f"freee_journals_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        # アップロード本体は bytes に読み出さず，受信済みの一時ファイル（大きければディスク）をそのまま渡す
+        # pandas / zip の重い処理はスレッドへ逃がし，イベントループを止めない
+        loop = asyncio.get_running_loop()
+        mem, filename = await loop.run_in_executor(EXECUTOR, _process, file.file, file.filename or "uploaded")
         return StreamingResponse(mem, media_type="application/zip",
                                  headers={"Content-Disposition": f"attachment; filename={filename}"})
     except Exception as e: